@@ -14,7 +14,7 @@ use sequoia_openpgp::serialize::{
 use sequoia_openpgp::Cert;
 use std::borrow::Cow;
 use std::fs::File;
-use std::io::{self, BufWriter, Read, Write};
+use std::io::{self, BufReader, BufWriter, Read, Write};
 use std::path::{Path, PathBuf};
 use std::str::FromStr;
 use std::string::FromUtf8Error;
@@ -26,6 +26,10 @@ mod stream;
 
 const STANDARD_POLICY: &StandardPolicy = &StandardPolicy::new();
 
+// Every read from a Python stream calls back into Python, so read from it in
+// large chunks instead of the 8 KiB that `io::copy()` asks for.
+const STREAM_BUFFER_SIZE: usize = 1 << 20;
+
 #[derive(thiserror::Error, Debug)]
 pub enum Error {
     #[error("OpenPGP error: {0}")]
@@ -144,7 +148,10 @@ pub fn encrypt_stream(
     plaintext: &PyAny,
     destination: PathBuf,
 ) -> Result<()> {
-    let stream = stream::Stream { reader: plaintext };
+    let stream = BufReader::with_capacity(
+        STREAM_BUFFER_SIZE,
+        stream::Stream { reader: plaintext },
+    );
     encrypt(&recipients, stream, &destination, None)
 }
 
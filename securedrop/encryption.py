@@ -1,12 +1,16 @@
+import functools
 import os
 import re
+import secrets
 import typing
+from contextlib import contextmanager
 from io import BytesIO
 from pathlib import Path
-from typing import BinaryIO, Dict, Optional
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
 
 import pretty_bad_protocol as gnupg
 from redis import Redis
+from redis.exceptions import LockNotOwnedError
 from sdconfig import SecureDropConfig
 
 import redwood
@@ -34,13 +38,60 @@ class GpgDecryptError(Exception):
 _default_encryption_mgr: Optional["EncryptionManager"] = None
 
 
+@functools.lru_cache
+def _get_gpg(homedir: str, options: Tuple[str, ...]) -> gnupg.GPG:
+    """Return the GPG instance shared by all the EncryptionManager instances using this keyring.
+
+    Creating a GPG instance spawns gpg2 to check its version, so only do it once per set of options.
+    """
+    return gnupg.GPG(binary="gpg2", homedir=homedir, options=list(options))
+
+
+@contextmanager
+def _atomic_destination(destination: Path) -> Iterator[Path]:
+    """Yield a temporary path next to `destination`, moved into place once it has been written.
+
+    This ensures other processes never read a partially-written ciphertext. The file is moved by
+    hard-linking it to `destination`, which like redwood refuses to overwrite an existing file:
+    two concurrent submissions from the same source may race for the same filename.
+    """
+    tmp_path = destination.with_name(f".{destination.name}.{secrets.token_hex(8)}.tmp")
+    try:
+        yield tmp_path
+        os.link(tmp_path, destination)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
 class EncryptionManager:
     """EncryptionManager provides a high-level interface for each PGP operation we do"""
 
     REDIS_FINGERPRINT_HASH = "sd/crypto-util/fingerprints"
     REDIS_KEY_HASH = "sd/crypto-util/keys"
-
-    SOURCE_KEY_UID_RE = re.compile(r"(Source|Autogenerated) Key <([-A-Za-z0-9+/=_]+)>")
+    REDIS_KEY_LOCK_PREFIX = "sd/crypto-util/key-locks/"
+
+    # How long (in seconds) a public key export may hold its lock, and how long other processes
+    # needing the same key wait for it before exporting the key themselves
+    KEY_EXPORT_LOCK_TIMEOUT = 5
+
+    # Lua script resolving a source's fingerprint and then its public key within Redis, so that
+    # both lookups only cost a single round-trip. A missing hash field is `false` in Lua, hence
+    # the script returns either [], [fingerprint] or [fingerprint, public_key]
+    REDIS_SOURCE_PUBLIC_KEY_SCRIPT = """
+        local fingerprint = redis.call("HGET", KEYS[1], ARGV[1])
+        if not fingerprint then
+            return {}
+        end
+        local public_key = redis.call("HGET", KEYS[2], fingerprint)
+        if not public_key then
+            return {fingerprint}
+        end
+        return {fingerprint, public_key}
+    """
+
+    SOURCE_KEY_UID_RE = re.compile(r"(Source|Autogenerated) Key <([-A-Za-z0-9+/=_]+)>", re.ASCII)
+    # Literal prefixes of SOURCE_KEY_UID_RE, to cheaply skip the UIDs that can't match it
+    SOURCE_KEY_UID_PREFIXES = ("Source Key <", "Autogenerated Key <")
 
     def __init__(self, gpg_key_dir: Path, journalist_pub_key: Path, redis: Redis) -> None:
         self._gpg_key_dir = gpg_key_dir
@@ -50,6 +101,16 @@ class EncryptionManager:
                 f"The journalist public key does not exist at {self.journalist_pub_key}"
             )
         self._redis = redis
+        # In-process caches in front of Redis: the journalist key is fixed for the lifetime of
+        # the process, and a source's key pair is never modified after it was generated
+        self._journalist_public_key: Optional[str] = None
+        self._source_key_fingerprint_cache: Dict[str, str] = {}
+        self._public_key_cache: Dict[str, str] = {}
+        # Source keys in the GPG keyring, indexed by the source's filesystem ID; built on first use
+        self._keyring_index: Optional[Dict[str, Dict[str, str]]] = None
+        self._get_source_public_key_from_redis = self._redis.register_script(
+            self.REDIS_SOURCE_PUBLIC_KEY_SCRIPT
+        )
 
         # Instantiate the "main" GPG binary
         self._gpg = None
@@ -65,18 +126,16 @@ class EncryptionManager:
                 # GPG binary to be used for key deletion: always delete keys without
                 # invoking pinentry-mode=loopback
                 # see: https://lists.gnupg.org/pipermail/gnupg-users/2016-May/055965.html
-                self._gpg_for_key_deletion = gnupg.GPG(
-                    binary="gpg2",
-                    homedir=str(self._gpg_key_dir),
-                    options=["--yes", "--trust-model direct"],
+                self._gpg_for_key_deletion = _get_gpg(
+                    str(self._gpg_key_dir),
+                    ("--yes", "--trust-model direct", "--no-auto-check-trustdb"),
                 )
             return self._gpg_for_key_deletion
         else:
             if self._gpg is None:
-                self._gpg = gnupg.GPG(
-                    binary="gpg2",
-                    homedir=str(self._gpg_key_dir),
-                    options=["--pinentry-mode loopback", "--trust-model direct"],
+                self._gpg = _get_gpg(
+                    str(self._gpg_key_dir),
+                    ("--pinentry-mode loopback", "--trust-model direct", "--no-auto-check-trustdb"),
                 )
             return self._gpg
 
@@ -108,25 +167,70 @@ class EncryptionManager:
         # The subkeys keyword argument deletes both secret and public keys
         self.gpg(for_deletion=True).delete_keys(source_key_fingerprint, secret=True, subkeys=True)
 
-        self._redis.hdel(self.REDIS_KEY_HASH, source_key_fingerprint)
-        self._redis.hdel(self.REDIS_FINGERPRINT_HASH, source_filesystem_id)
+        # Remove both cached entries in a single round-trip to Redis
+        with self._redis.pipeline() as pipe:
+            pipe.hdel(self.REDIS_KEY_HASH, source_key_fingerprint)
+            pipe.hdel(self.REDIS_FINGERPRINT_HASH, source_filesystem_id)
+            pipe.execute()
+        self._source_key_fingerprint_cache.pop(source_filesystem_id, None)
+        self._public_key_cache.pop(source_key_fingerprint, None)
+        if self._keyring_index is not None:
+            self._keyring_index.pop(source_filesystem_id, None)
+
+    def reset_keyring_index(self) -> None:
+        """Discard the index of the source keys in the GPG keyring, so that it gets rebuilt.
+
+        New sources get Sequoia keys, hence source keys are never added to the keyring in
+        production; this must be called after adding one anyway (ie. in tests and dev data).
+        """
+        self._keyring_index = None
 
     def get_journalist_public_key(self) -> str:
-        return self.journalist_pub_key.read_text()
+        if self._journalist_public_key is None:
+            self._journalist_public_key = self.journalist_pub_key.read_text()
+        return self._journalist_public_key
 
     def get_source_public_key(self, source_filesystem_id: str) -> str:
-        source_key_fingerprint = self.get_source_key_fingerprint(source_filesystem_id)
+        # First check the in-process cache
+        source_key_fingerprint = self._source_key_fingerprint_cache.get(source_filesystem_id)
+        if source_key_fingerprint:
+            return self._get_public_key(source_key_fingerprint)
+
+        # Then try to fetch both the fingerprint and the public key from Redis at once
+        cached_values = self._get_source_public_key_from_redis(
+            keys=[self.REDIS_FINGERPRINT_HASH, self.REDIS_KEY_HASH], args=[source_filesystem_id]
+        )
+        if len(cached_values) == 2:
+            source_key_fingerprint, public_key = cached_values
+            self._source_key_fingerprint_cache[source_filesystem_id] = source_key_fingerprint
+            self._public_key_cache[source_key_fingerprint] = public_key
+            return public_key
+
+        # Then fall back to looking up whatever is missing
+        if cached_values:
+            source_key_fingerprint = cached_values[0]
+        else:
+            source_key_fingerprint = self.get_source_key_fingerprint(source_filesystem_id)
         return self._get_public_key(source_key_fingerprint)
 
     def get_source_key_fingerprint(self, source_filesystem_id: str) -> str:
+        source_key_fingerprint = self._source_key_fingerprint_cache.get(source_filesystem_id)
+        if source_key_fingerprint:
+            return source_key_fingerprint
+
         source_key_fingerprint = self._redis.hget(self.REDIS_FINGERPRINT_HASH, source_filesystem_id)
         if source_key_fingerprint:
+            self._source_key_fingerprint_cache[source_filesystem_id] = source_key_fingerprint
             return source_key_fingerprint
 
         # If the fingerprint was not in Redis, get it directly from GPG
+        keyring_index_was_built = self._keyring_index is not None
         source_key_details = self._get_source_key_details(source_filesystem_id)
         source_key_fingerprint = source_key_details["fingerprint"]
-        self._save_key_fingerprint_to_redis(source_filesystem_id, source_key_fingerprint)
+        if keyring_index_was_built:
+            # Otherwise building the keyring index just saved the fingerprint to Redis
+            self._save_key_fingerprint_to_redis(source_filesystem_id, source_key_fingerprint)
+        self._source_key_fingerprint_cache[source_filesystem_id] = source_key_fingerprint
         return source_key_fingerprint
 
     def get_source_secret_key_from_gpg(self, fingerprint: str, passphrase: str) -> str:
@@ -146,30 +250,33 @@ class EncryptionManager:
         return secret_key
 
     def encrypt_source_message(self, message_in: str, encrypted_message_path_out: Path) -> None:
-        redwood.encrypt_message(
-            # A submission is only encrypted for the journalist key
-            recipients=[self.get_journalist_public_key()],
-            plaintext=message_in,
-            destination=encrypted_message_path_out,
-        )
+        with _atomic_destination(encrypted_message_path_out) as destination:
+            redwood.encrypt_message(
+                # A submission is only encrypted for the journalist key
+                recipients=[self.get_journalist_public_key()],
+                plaintext=message_in,
+                destination=destination,
+            )
 
     def encrypt_source_file(self, file_in: BinaryIO, encrypted_file_path_out: Path) -> None:
-        redwood.encrypt_stream(
-            # A submission is only encrypted for the journalist key
-            recipients=[self.get_journalist_public_key()],
-            plaintext=file_in,
-            destination=encrypted_file_path_out,
-        )
+        with _atomic_destination(encrypted_file_path_out) as destination:
+            redwood.encrypt_stream(
+                # A submission is only encrypted for the journalist key
+                recipients=[self.get_journalist_public_key()],
+                plaintext=file_in,
+                destination=destination,
+            )
 
     def encrypt_journalist_reply(
         self, for_source: "Source", reply_in: str, encrypted_reply_path_out: Path
     ) -> None:
-        redwood.encrypt_message(
-            # A reply is encrypted for both the journalist key and the source key
-            recipients=[for_source.public_key, self.get_journalist_public_key()],
-            plaintext=reply_in,
-            destination=encrypted_reply_path_out,
-        )
+        with _atomic_destination(encrypted_reply_path_out) as destination:
+            redwood.encrypt_message(
+                # A reply is encrypted for both the journalist key and the source key
+                recipients=[for_source.public_key, self.get_journalist_public_key()],
+                plaintext=reply_in,
+                destination=destination,
+            )
 
     def decrypt_journalist_reply(self, for_source_user: "SourceUser", ciphertext_in: bytes) -> str:
         """Decrypt a reply sent by a journalist."""
@@ -190,11 +297,34 @@ class EncryptionManager:
         return out.data.decode("utf-8")
 
     def _get_source_key_details(self, source_filesystem_id: str) -> Dict[str, str]:
+        if self._keyring_index is None:
+            self._keyring_index = self._build_keyring_index()
+        try:
+            return self._keyring_index[source_filesystem_id]
+        except KeyError:
+            raise GpgKeyNotFoundError()
+
+    def _build_keyring_index(self) -> Dict[str, Dict[str, str]]:
+        keyring_index: Dict[str, Dict[str, str]] = {}
         for key in self.gpg().list_keys():
             for uid in key["uids"]:
-                if source_filesystem_id in uid and self.SOURCE_KEY_UID_RE.match(uid):
-                    return key
-        raise GpgKeyNotFoundError()
+                if not uid.startswith(self.SOURCE_KEY_UID_PREFIXES):
+                    continue
+                uid_match = self.SOURCE_KEY_UID_RE.match(uid)
+                if uid_match:
+                    keyring_index.setdefault(uid_match.group(2), key)
+
+        # Save all the fingerprints to Redis at once, so that lookups for the other sources don't
+        # have to list the keyring again, including from other processes
+        if keyring_index:
+            self._redis.hset(
+                self.REDIS_FINGERPRINT_HASH,
+                mapping={
+                    source_filesystem_id: key["fingerprint"]
+                    for source_filesystem_id, key in keyring_index.items()
+                },
+            )
+        return keyring_index
 
     def _save_key_fingerprint_to_redis(
         self, source_filesystem_id: str, source_key_fingerprint: str
@@ -202,15 +332,41 @@ class EncryptionManager:
         self._redis.hset(self.REDIS_FINGERPRINT_HASH, source_filesystem_id, source_key_fingerprint)
 
     def _get_public_key(self, key_fingerprint: str) -> str:
-        # First try to fetch the public key from Redis
-        public_key = self._redis.hget(self.REDIS_KEY_HASH, key_fingerprint)
+        # First check the in-process cache
+        public_key = self._public_key_cache.get(key_fingerprint)
         if public_key:
             return public_key
 
-        # Then directly from GPG
-        public_key = self.gpg().export_keys(key_fingerprint)
-        if not public_key:
-            raise GpgKeyNotFoundError()
+        # Then try to fetch the public key from Redis
+        public_key = self._redis.hget(self.REDIS_KEY_HASH, key_fingerprint)
+        if public_key:
+            self._public_key_cache[key_fingerprint] = public_key
+            return public_key
 
-        self._redis.hset(self.REDIS_KEY_HASH, key_fingerprint, public_key)
+        # Then directly from GPG; only let one process at a time export a given key, so that
+        # concurrent requests for a key that isn't cached yet don't all spawn gpg2
+        lock = self._redis.lock(
+            f"{self.REDIS_KEY_LOCK_PREFIX}{key_fingerprint}",
+            timeout=self.KEY_EXPORT_LOCK_TIMEOUT,
+            blocking_timeout=self.KEY_EXPORT_LOCK_TIMEOUT,
+        )
+        lock_acquired = lock.acquire()
+        try:
+            # The key may have been exported by another process while waiting for the lock
+            public_key = self._redis.hget(self.REDIS_KEY_HASH, key_fingerprint)
+            if not public_key:
+                public_key = self.gpg().export_keys(key_fingerprint)
+                if not public_key:
+                    raise GpgKeyNotFoundError()
+
+                self._redis.hset(self.REDIS_KEY_HASH, key_fingerprint, public_key)
+        finally:
+            if lock_acquired:
+                try:
+                    lock.release()
+                except LockNotOwnedError:
+                    # The lock may have expired if the export took too long
+                    pass
+
+        self._public_key_cache[key_fingerprint] = public_key
         return public_key
@@ -278,6 +278,7 @@ def add_source(use_gpg: bool = False) -> Tuple[Source, str]:
             expire_date="0",
         )
         manager.gpg().gen_key(gen_key_input)
+        manager.reset_keyring_index()
 
         # Delete the Sequoia-generated keys
         source.pgp_public_key = None
@@ -552,7 +552,9 @@ class GPGBase:
             ):
                 # GnuPG<=1.4.18 parses the `--debug-level` command in a way
                 # that is incompatible with all other GnuPG versions. :'(
-                if self.binary_version and (self.binary_version <= "1.4.18"):
+                if self.binary_version and (
+                    tuple(int(part) for part in self.binary_version.split(".")) <= (1, 4, 18)
+                ):
                     cmd.append("--debug-level=%s" % self.verbose)
                 else:
                     cmd.append("--debug-level %s" % self.verbose)
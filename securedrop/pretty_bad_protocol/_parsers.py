@@ -609,6 +609,7 @@ def _get_options_group(group=None):  # type: ignore[no-untyped-def]
             "--lock-multiple",
             "--lock-never",
             "--lock-once",
+            "--no-auto-check-trustdb",
             "--no-default-keyring",
             "--no-default-recipient",
             "--no-emit-version",
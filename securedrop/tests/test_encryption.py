@@ -1,3 +1,7 @@
+import secrets
+import threading
+import time
+from io import BytesIO
 from pathlib import Path
 from unittest.mock import MagicMock
 
@@ -22,6 +26,23 @@ class TestEncryptionManager:
         # It succeeds
         assert redwood.is_valid_public_key(encryption_mgr.get_journalist_public_key())
 
+    def test_gpg_shared_across_encryption_managers(self, config):
+        # Given two encryption managers using the same keyring
+        encryption_mgrs = [
+            EncryptionManager(
+                gpg_key_dir=config.GPG_KEY_DIR,
+                journalist_pub_key=(config.SECUREDROP_DATA_ROOT / "journalist.pub"),
+                redis=Redis(decode_responses=True, **config.REDIS_KWARGS),
+            )
+            for _ in range(2)
+        ]
+
+        # They use the same GPG instances
+        assert encryption_mgrs[0].gpg() is encryption_mgrs[1].gpg()
+        assert encryption_mgrs[0].gpg(for_deletion=True) is encryption_mgrs[1].gpg(
+            for_deletion=True
+        )
+
     def test_get_gpg_source_public_key(self, test_source):
         # Given a source user with a key pair in the gpg keyring
         source_user = test_source["source_user"]
@@ -42,6 +63,177 @@ class TestEncryptionManager:
         # And the public key was saved to Redis
         assert encryption_mgr._redis.hget(encryption_mgr.REDIS_KEY_HASH, source_key_fingerprint)
 
+    def test_get_gpg_source_public_key_cached(self, test_source, mocker):
+        # Given a source user whose public key was already fetched once
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        utils.create_legacy_gpg_key(encryption_mgr, source_user, test_source["source"])
+        source_pub_key = encryption_mgr.get_source_public_key(source_user.filesystem_id)
+
+        # When using the encryption manager to fetch the source user's public key again
+        # It succeeds without querying GPG
+        gpg_spy = mocker.spy(encryption_mgr, "gpg")
+        assert encryption_mgr.get_source_public_key(source_user.filesystem_id) == source_pub_key
+        gpg_spy.assert_not_called()
+
+    def test_get_gpg_source_public_key_only_fingerprint_in_redis(self, test_source, config):
+        # Given a source user with a key pair in the gpg keyring
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        fingerprint = utils.create_legacy_gpg_key(
+            encryption_mgr, source_user, test_source["source"]
+        )
+
+        # And whose key fingerprint is in Redis, but not their public key
+        encryption_mgr._redis.hset(
+            encryption_mgr.REDIS_FINGERPRINT_HASH, source_user.filesystem_id, fingerprint
+        )
+        encryption_mgr._redis.hdel(encryption_mgr.REDIS_KEY_HASH, fingerprint)
+
+        # When using a fresh encryption manager to fetch the source user's public key
+        fresh_encryption_mgr = EncryptionManager(
+            gpg_key_dir=config.GPG_KEY_DIR,
+            journalist_pub_key=(config.SECUREDROP_DATA_ROOT / "journalist.pub"),
+            redis=Redis(decode_responses=True, **config.REDIS_KWARGS),
+        )
+        source_pub_key = fresh_encryption_mgr.get_source_public_key(source_user.filesystem_id)
+
+        # It succeeds
+        assert redwood.is_valid_public_key(source_pub_key)
+
+        # And the public key was saved to Redis
+        assert fresh_encryption_mgr._redis.hget(encryption_mgr.REDIS_KEY_HASH, fingerprint)
+
+    def test_get_source_key_details_uses_keyring_index(self, test_source, mocker):
+        # Given a source user with a key pair in the gpg keyring
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        fingerprint = utils.create_legacy_gpg_key(
+            encryption_mgr, source_user, test_source["source"]
+        )
+        list_keys_spy = mocker.spy(encryption_mgr.gpg(), "list_keys")
+
+        # When looking up the source user's key details several times
+        # It succeeds
+        for _ in range(3):
+            key = encryption_mgr._get_source_key_details(source_user.filesystem_id)
+            assert key["fingerprint"] == fingerprint
+
+        # And the keyring was only listed once
+        assert list_keys_spy.call_count == 1
+
+    def test_get_source_key_details_without_gpg_key_uses_keyring_index(self, test_source, mocker):
+        # Given a source user without a key pair in the gpg keyring
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        list_keys_spy = mocker.spy(encryption_mgr.gpg(), "list_keys")
+
+        # When looking up the source user's key details several times
+        # It fails
+        for _ in range(2):
+            with pytest.raises(GpgKeyNotFoundError):
+                encryption_mgr._get_source_key_details(source_user.filesystem_id)
+
+        # And the keyring was listed at most once
+        assert list_keys_spy.call_count <= 1
+
+    def test_keyring_index_saves_fingerprints_to_redis(self, test_source):
+        # Given a source user with a key pair in the gpg keyring but not in Redis
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        fingerprint = utils.create_legacy_gpg_key(
+            encryption_mgr, source_user, test_source["source"]
+        )
+        encryption_mgr._redis.hdel(encryption_mgr.REDIS_FINGERPRINT_HASH, source_user.filesystem_id)
+
+        # When the keyring index gets built
+        encryption_mgr._get_source_key_details(source_user.filesystem_id)
+
+        # Then the source user's key fingerprint was saved to Redis
+        assert (
+            encryption_mgr._redis.hget(
+                encryption_mgr.REDIS_FINGERPRINT_HASH, source_user.filesystem_id
+            )
+            == fingerprint
+        )
+
+    def test_keyring_index_saves_fingerprints_to_redis_once(self, test_source, mocker):
+        # Given a source user without a key pair in the gpg keyring
+        source_user = test_source["source_user"]
+        encryption_mgr = EncryptionManager.get_default()
+        encryption_mgr.reset_keyring_index()
+        hset_spy = mocker.spy(encryption_mgr._redis, "hset")
+
+        # When looking up the source user's key fingerprint several times
+        # It fails
+        for _ in range(2):
+            with pytest.raises(GpgKeyNotFoundError):
+                encryption_mgr.get_source_key_fingerprint(source_user.filesystem_id)
+
+        # And the fingerprints in the keyring were saved to Redis at most once
+        assert hset_spy.call_count <= 1
+
+    def test_get_gpg_source_public_key_after_keyring_index_build(
+        self, test_source, app_storage, config
+    ):
+        # Given two source users with a key pair in the gpg keyring
+        source_user1 = test_source["source_user"]
+        source_user2 = create_source_user(
+            db_session=db.session,
+            source_passphrase=PassphraseGenerator.get_default().generate_passphrase(),
+            source_app_storage=app_storage,
+        )
+        encryption_mgr = EncryptionManager.get_default()
+        utils.create_legacy_gpg_key(encryption_mgr, source_user1, test_source["source"])
+        utils.create_legacy_gpg_key(encryption_mgr, source_user2, source_user2.get_db_record())
+
+        # And the keyring index was built when looking up source1's public key, which saved
+        # source2's key fingerprint to Redis but not their public key
+        assert encryption_mgr.get_source_public_key(source_user1.filesystem_id)
+
+        # When using a fresh encryption manager to fetch source2's public key
+        fresh_encryption_mgr = EncryptionManager(
+            gpg_key_dir=config.GPG_KEY_DIR,
+            journalist_pub_key=(config.SECUREDROP_DATA_ROOT / "journalist.pub"),
+            redis=Redis(decode_responses=True, **config.REDIS_KWARGS),
+        )
+        source_pub_key = fresh_encryption_mgr.get_source_public_key(source_user2.filesystem_id)
+
+        # It succeeds
+        assert redwood.is_valid_public_key(source_pub_key)
+
+    def test_get_public_key_waits_for_concurrent_export(self, config, mocker):
+        # Given an encryption manager
+        encryption_mgr = EncryptionManager.get_default()
+
+        # And another process currently exporting a public key that isn't in Redis yet
+        fingerprint = secrets.token_hex(20).upper()
+        lock = encryption_mgr._redis.lock(
+            f"{encryption_mgr.REDIS_KEY_LOCK_PREFIX}{fingerprint}",
+            timeout=encryption_mgr.KEY_EXPORT_LOCK_TIMEOUT,
+            # The lock gets released from the timer's thread
+            thread_local=False,
+        )
+        assert lock.acquire()
+
+        def finish_export():
+            encryption_mgr._redis.hset(encryption_mgr.REDIS_KEY_HASH, fingerprint, "public key")
+            lock.release()
+
+        export_timer = threading.Timer(0.5, finish_export)
+        export_timer.start()
+
+        # When using the encryption manager to fetch the same public key
+        # It gets the key exported by the other process without exporting it again
+        export_keys_spy = mocker.spy(encryption_mgr.gpg(), "export_keys")
+        start_time = time.monotonic()
+        assert encryption_mgr._get_public_key(fingerprint) == "public key"
+        export_keys_spy.assert_not_called()
+
+        # And it stopped waiting as soon as the lock was released, rather than when it expired
+        assert time.monotonic() - start_time < encryption_mgr.KEY_EXPORT_LOCK_TIMEOUT / 2
+        export_timer.join()
+
     def test_get_gpg_source_public_key_wrong_id(self, test_source):
         # Given an encryption manager
         encryption_mgr = EncryptionManager.get_default()
@@ -116,6 +308,9 @@ class TestEncryptionManager:
             message_in=message, encrypted_message_path_out=encrypted_message_path
         )
 
+        # And only the output file was written
+        assert list(tmp_path.iterdir()) == [encrypted_message_path]
+
         # And the output file doesn't contain the message plaintext
         encrypted_message = encrypted_message_path.read_bytes()
         assert message.encode() not in encrypted_message
@@ -124,6 +319,54 @@ class TestEncryptionManager:
         decrypted_message = utils.decrypt_as_journalist(encrypted_message).decode()
         assert decrypted_message == message
 
+    def test_encrypt_source_message_does_not_overwrite_existing_file(self, config, tmp_path):
+        # Given an encryption manager
+        encryption_mgr = EncryptionManager.get_default()
+
+        # And an existing ciphertext at the destination
+        encrypted_message_path = tmp_path / "message.gpg"
+        encrypted_message_path.write_bytes(b"existing ciphertext")
+
+        # When the source tries to encrypt a message to the same destination
+        # It fails
+        with pytest.raises(FileExistsError):
+            encryption_mgr.encrypt_source_message(
+                message_in="s3cr3t message", encrypted_message_path_out=encrypted_message_path
+            )
+
+        # And the existing ciphertext was left untouched
+        assert encrypted_message_path.read_bytes() == b"existing ciphertext"
+        assert list(tmp_path.iterdir()) == [encrypted_message_path]
+
+    def test_encrypt_source_file_failure_leaves_no_file(self, config, tmp_path):
+        # Given an encryption manager
+        encryption_mgr = EncryptionManager.get_default()
+
+        # And a file to be submitted by a source, which fails to be read partway through
+        files_during_encryption = []
+
+        class FailingFile(BytesIO):
+            def read(self, size=-1):
+                if self.tell() > 0:
+                    files_during_encryption.extend(tmp_path.iterdir())
+                    raise OSError("Read failed")
+                return super().read(1024)
+
+        # When the source tries to encrypt the file
+        # It fails
+        with pytest.raises(RedwoodError):
+            encryption_mgr.encrypt_source_file(
+                file_in=FailingFile(b"s3cr3t file" * 1024),
+                encrypted_file_path_out=tmp_path / "file.gpg",
+            )
+
+        # And the ciphertext was being written to a temporary file when the read failed
+        assert len(files_during_encryption) == 1
+        assert files_during_encryption[0].name.endswith(".tmp")
+
+        # And no file, complete or partial, was left behind
+        assert list(tmp_path.iterdir()) == []
+
     def test_encrypt_source_file(self, config, tmp_path):
         # Given an encryption manager
         encryption_mgr = EncryptionManager.get_default()
@@ -115,6 +115,7 @@ def create_legacy_gpg_key(
         expire_date="0",
     )
     result = manager.gpg().gen_key(gen_key_input)
+    manager.reset_keyring_index()
 
     # Delete the Sequoia-generated keys
     source.pgp_public_key = None